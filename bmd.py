@@ -5,6 +5,8 @@
 
 import binascii
 import enum
+import os
+import selectors
 import struct
 import sys
 
@@ -131,40 +133,44 @@ class SpeedEditorJogMode(enum.IntEnum):
 	# here is minimal, just enough to make the keyboard start working
 
 
+AUTH_EVEN_TBL = [
+	0x3ae1206f97c10bc8,
+	0x2a9ab32bebf244c6,
+	0x20a6f8b8df9adf0a,
+	0xaf80ece52cfc1719,
+	0xec2ee2f7414fd151,
+	0xb055adfd73344a15,
+	0xa63d2e3059001187,
+	0x751bf623f42e0dde,
+]
+
+AUTH_ODD_TBL = [
+	0x3e22b34f502e7fde,
+	0x24656b981875ab1c,
+	0xa17f3456df7bf8c3,
+	0x6df72e1941aef698,
+	0x72226f011e66ab94,
+	0x3831a3c606296b42,
+	0xfd7ff81881332c89,
+	0x61a3f6474ff236c6,
+]
+
+AUTH_MASK = 0xa79a63f585d37bf0
+
+
 def rol8(v):
 	return ((v << 56) | (v >> 8)) & 0xffffffffffffffff
 
 
 def rol8n(v, n):
-	for i in range(n):
-		v = rol8(v)
-	return v
+	# n successive 8 bits rotations is a single 8*n bits rotation
+	n = (8 * n) & 63
+	if n == 0:
+		return v
+	return ((v << (64 - n)) | (v >> n)) & 0xffffffffffffffff
 
 
 def bmd_kbd_auth(challenge):
-
-	AUTH_EVEN_TBL = [
-		0x3ae1206f97c10bc8,
-		0x2a9ab32bebf244c6,
-		0x20a6f8b8df9adf0a,
-		0xaf80ece52cfc1719,
-		0xec2ee2f7414fd151,
-		0xb055adfd73344a15,
-		0xa63d2e3059001187,
-		0x751bf623f42e0dde,
-	]
-	AUTH_ODD_TBL = [
-		0x3e22b34f502e7fde,
-		0x24656b981875ab1c,
-		0xa17f3456df7bf8c3,
-		0x6df72e1941aef698,
-		0x72226f011e66ab94,
-		0x3831a3c606296b42,
-		0xfd7ff81881332c89,
-		0x61a3f6474ff236c6,
-	]
-	MASK = 0xa79a63f585d37bf0
-
 	n = challenge & 7
 	v = rol8n(challenge, n)
 
@@ -174,7 +180,7 @@ def bmd_kbd_auth(challenge):
 		v = v ^ rol8(v)
 		k = AUTH_ODD_TBL[n]
 
-	return v ^ (rol8(v) & MASK) ^ k
+	return v ^ (rol8(v) & AUTH_MASK) ^ k
 
 
 # ----------------------------------------------------------------------------
@@ -200,6 +206,16 @@ class SpeedEditorHandler:
 		pass
 
 
+# Pre-compiled report formats (see _parse_report_xx for details)
+_S_R03 = struct.Struct('<BBiB')
+_S_R04_KEYS = struct.Struct('<6H')
+_S_R07 = struct.Struct('<BBB')
+
+# Direct value -> member maps of the enums used when parsing reports
+_KEY_MAP = SpeedEditorKey._value2member_map_
+_JOGMODE_MAP = SpeedEditorJogMode._value2member_map_
+
+
 class SpeedEditor:
 
 	USB_VID			= 0x1edb
@@ -207,6 +223,46 @@ class SpeedEditor:
 
 	def __init__(self):
 		self.dev = hid.Device(self.USB_VID, self.USB_PID)
+		self._dispatch = {
+			0x03: self._parse_report_03,
+			0x04: self._parse_report_04,
+			0x07: self._parse_report_07,
+		}
+		self._last_leds = None
+		self._last_jog_leds = None
+		self._open_hidraw()
+
+	def _open_hidraw(self):
+		# On Linux, input reports are read directly from the hidraw node so
+		# we can wait using epoll and then drain everything that's pending in
+		# one go. hidapi is still used for everything else.
+		self._fd  = None
+		self._sel = None
+
+		if not hasattr(selectors, 'EpollSelector'):
+			return
+
+		hid_id = 'HID_ID=0003:%08X:%08X' % (self.USB_VID, self.USB_PID)
+
+		try:
+			nodes = sorted(os.listdir('/sys/class/hidraw'))
+		except OSError:
+			return
+
+		for node in nodes:
+			try:
+				with open(f'/sys/class/hidraw/{node:s}/device/uevent', 'r') as fh:
+					if hid_id not in fh.read().split():
+						continue
+				fd = os.open(f'/dev/{node:s}', os.O_RDONLY | os.O_NONBLOCK)
+			except OSError:
+				continue
+
+			self._fd  = fd
+			self._buf = bytearray(64)
+			self._sel = selectors.EpollSelector()
+			self._sel.register(fd, selectors.EVENT_READ)
+			return
 
 	def authenticate(self):
 		# The authentication is performed over SET_FEATURE/GET_FEATURE on
@@ -248,12 +304,22 @@ class SpeedEditor:
 		self.handler = handler
 
 	def set_leds(self, leds : SpeedEditorLed):
-		self.dev.write(struct.pack('<BI', 2, leds))
+		# Skip the USB transfer if nothing changes
+		report = struct.pack('<BI', 2, leds)
+		if report != self._last_leds:
+			self.dev.write(report)
+			self._last_leds = report
 
 	def set_jog_leds(self, jogleds : SpeedEditorJogLed):
-		self.dev.write(struct.pack('<BB', 4, jogleds))
+		# Skip the USB transfer if nothing changes
+		report = struct.pack('<BB', 4, jogleds)
+		if report != self._last_jog_leds:
+			self.dev.write(report)
+			self._last_jog_leds = report
 
 	def set_jog_mode(self, jogmode : SpeedEditorJogMode, unknown=255):
+		# Always sent, even if unchanged, since this also resets the
+		# reference position for the absolute modes
 		self.dev.write(struct.pack('<BBIB', 3, jogmode, 0, unknown))
 
 	def _parse_report_03(self, report):
@@ -262,14 +328,16 @@ class SpeedEditor:
 		# u8   - Jog mode
 		# le32 - Jog value (signed)
 		# u8   - Unknown ?
-		rid, jm, jv, ju = struct.unpack('<BBiB', report)
-		return self.handler.jog(SpeedEditorJogMode(jm), jv)
+		rid, jm, jv, ju = _S_R03.unpack_from(report, 0)
+		jm = _JOGMODE_MAP[jm] if jm in _JOGMODE_MAP else SpeedEditorJogMode(jm)
+		return self.handler.jog(jm, jv)
 
 	def _parse_report_04(self, report):
 		# Report ID 04
 		# u8      - Report ID
 		# le16[6] - Array of keys held down
-		keys = [SpeedEditorKey(k) for k in struct.unpack('<6H', report[1:]) if k != 0]
+		km = _KEY_MAP
+		keys = [km[k] if k in km else SpeedEditorKey(k) for k in _S_R04_KEYS.unpack_from(report, 1) if k != 0]
 		return self.handler.key(keys)
 
 	def _parse_report_07(self, report):
@@ -277,18 +345,47 @@ class SpeedEditor:
 		# u8 - Report ID
 		# u8 - Charging (1) / Not-charging (0)
 		# u8 - Battery level (0-100)
-		rid, bs, bl = struct.unpack('<BBB', report)
+		rid, bs, bl = _S_R07.unpack_from(report, 0)
 		return self.handler.battery(bool(bs), bl)
 
+	def _handle_report(self, report):
+		# Parse and dispatch to handler
+		h = self._dispatch.get(report[0])
+		if h:
+			return h(report)
+		else:
+			print(f"[!] Unhandled report {binascii.b2a_hex(report).decode('utf-8'):s}", file=sys.stderr)
+
+	def _poll_hidraw(self, timeout):
+		# Wait for data (timeout is in ms, same as hid.Device.read)
+		if not self._sel.select(None if timeout is None else (timeout / 1000)):
+			return
+
+		# Drain all pending REPORTs (always read into the same buffer)
+		rv = None
+		mv = memoryview(self._buf)
+
+		while True:
+			try:
+				n = os.readv(self._fd, [self._buf])
+			except BlockingIOError:
+				break
+
+			if n == 0:
+				break
+
+			rv = self._handle_report(mv[:n])
+
+		return rv
+
 	def poll(self, timeout=None):
+		# Use hidraw if we can
+		if self._sel is not None:
+			return self._poll_hidraw(timeout)
+
 		# Get REPORT
 		report = self.dev.read(64, timeout=timeout)
 		if len(report) == 0:
 			return
 
-		# Parse and dispatch to handler
-		h = getattr(self, f'_parse_report_{report[0]:02x}', None)
-		if h:
-			return h(report)
-		else:
-			print(f"[!] Unhandled report {binascii.b2a_hex(report).decode('utf-8'):s}", file=sys.stderr)
+		return self._handle_report(report)
@@ -7,7 +7,9 @@ Copyright (C) 2021 Sylvain Munaut <tnt@246tNt.com>
 SPDX-License-Identifier: Apache-2.0
 """
 
+import array
 import functools
+import itertools
 import mmap
 import os
 import struct
@@ -20,134 +22,176 @@ from collections import namedtuple
 # Metadata block parsing
 # ----------------------------------------------------------------------------
 
+_S_ATOM_HDR = struct.Struct('>II')
+
+
 class Atom:
 
 	__atoms = {}
+	__tags = {}
 
 	def __init__(self, data):
 		self.data = data
 
 	def serialize(self):
-		return self.data
+		# Compute final size first, then fill a single buffer
+		buf = bytearray(self._serialized_size())
+		self._serialize_into(buf, 0)
+		return buf
+
+	def _serialized_size(self):
+		return len(self.data)
+
+	def _serialize_into(self, buf, ofs):
+		buf[ofs:ofs+len(self.data)] = self.data
+		return ofs + len(self.data)
 
 	def print(self, lvl=0):
 		print("%6d %08x %s-%s" % (len(self.data), self.AID, lvl*' |', bytes(self.data[4:8]).decode('utf8')))
 
-	@classmethod
-	def all_atoms(cls):
-		return set(cls.__subclasses__()).union(
-				[s for c in cls.__subclasses__() for s in c.all_atoms()]
-			)
+	def __init_subclass__(cls, **kwargs):
+		# Register all atom classes as they're defined
+		super().__init_subclass__(**kwargs)
+		if 'AID' in cls.__dict__:
+			Atom.__atoms[cls.AID] = cls
+			Atom.__tags[cls.AID.to_bytes(4, 'big').decode('utf8')] = cls.AID
 
 	@classmethod
 	def for_aid(cls, aid, fallback=False):
-		# Maybe already there
-		if aid in cls.__atoms:
-			return cls.__atoms[aid]
-
-		# Update
-		for ac in cls.all_atoms():
-			if hasattr(ac, 'AID'):
-				cls.__atoms[ac.AID] = ac
-
 		# Fallback
 		if fallback:
-			if aid not in cls.__atoms:
-				return LeafAtom
+			return cls.__atoms.get(aid, LeafAtom)
 
 		# Get it (or error out if not found)
 		return cls.__atoms[aid]
 
+	@classmethod
+	def aid_for_tag(cls, tag):
+		# Known tags are looked up, others converted
+		aid = cls.__tags.get(tag)
+		if aid is None:
+			aid = struct.unpack('>I', bytes(tag, 'utf8'))[0]
+		return aid
+
 	@classmethod
 	def for_buf(cls, buf):
+		# Work on a memoryview so all children just reference the parent
+		# buffer instead of copying it
+		buf = memoryview(buf)
 		if len(buf) < 8:
 			raise ValueError('Buffer too small for ATOM')
-		alen, aid = struct.unpack('>II', buf[0:8])
+		alen, aid = _S_ATOM_HDR.unpack_from(buf, 0)
 		acls = cls.for_aid(aid)
 		return acls(buf[0:alen])
 
 
+def _scan_atoms(data, start):
+	# Walk the atoms stored back to back in data and return the
+	# (offset, length, aid) of each of them
+	rv = []
+	o = start
+	l = len(data)
+	unpack_from = _S_ATOM_HDR.unpack_from
+
+	while o <= (l-8):
+		alen, aid = unpack_from(data, o)
+		if alen < 8:
+			raise ValueError('Invalid ATOM length')
+		rv.append( (o, alen, aid) )
+		o += alen
+
+	if o != l:
+		raise ValueError('Data left over while parsing children list')
+
+	return rv
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_path(key):
+	# Split a 'xxxx[:idx]/yyyy[:idx]/...' path into a tuple of (aid, idx)
+	rv = []
+
+	for k in key.split('/'):
+		# Index
+		if ':' in k:
+			k, idx = k.split(':')
+			idx = int(idx)
+		else:
+			idx = None
+
+		# Check
+		if len(k) != 4:
+			raise KeyError('Invalid key %r' % k)
+
+		rv.append( (Atom.aid_for_tag(k), idx) )
+
+	return tuple(rv)
+
+
 class ContainerAtom(Atom):
 
 	def __init__(self, data):
 		# Super call
 		super().__init__(data)
 
-		# Children
+		# Children (and index by AID)
 		self.children = []
+		self._by_aid = {}
 
 		# Parse atoms inside it
-		o = 8
-		l = len(data)
-
-		while o <= (l-8):
-			# Get length and atom
-			alen, aid = struct.unpack('>II', data[o:o+8])
-
-			# Build atom
+		for o, alen, aid in _scan_atoms(data, 8):
 			acls = Atom.for_aid(aid)
 			ainst = acls(data[o:o+alen])
-
-			# Add it
 			self.children.append(ainst)
-
-			# Next
-			o += alen
-
-		# Error ?
-		if o != l:
-			raise ValueError('Data left over while parsing children list')
+			self._by_aid.setdefault(aid, []).append(ainst)
 
 	def __getitem__(self, key):
-		# Split into components
-		if '/' in key:
-			key, skey = key.split('/', 1)
-		else:
-			skey = None
+		node = self
 
-		# Index
-		if ':' in key:
-			key, idx = key.split(':')
-			idx = int(idx)
-		else:
-			idx = None
-
-		# Check
-		if len(key) != 4:
-			raise KeyError('Invalid key %r' % key)
+		for aid, idx in _parse_path(key):
+			# Find all matching children
+			if not isinstance(node, ContainerAtom):
+				raise KeyError('Atom %08x has no children' % node.AID)
 
-		key = struct.unpack('>I', bytes(key, 'utf8'))[0]
+			m = node._by_aid.get(aid, [])
 
-		# Find all matching children
-		m = [c for c in self.children if c.AID == key]
+			# Index handling
+			if len(m) == 0:
+				raise KeyError('No such key %08x' % aid)
+			elif (len(m) > 1) and (idx is None):
+				raise KeyError('Multiple key %08x and no index provided' % aid)
+			elif (idx is not None) and (len(m) <= idx):
+				raise KeyError('Invalid index %d for key %08x' % (idx, aid))
 
-		# Index handling
-		if len(m) == 0:
-			raise KeyError('No such key %08x' % key)
-		elif (len(m) > 1) and (idx is None):
-			raise KeyError('Multiple key %08x and no index provided' % key)
-		elif (idx is not None) and (len(m) <= idx):
-			raise KeyError('Invalid index %d for key %08x' % (idx, key))
+			# Next level
+			node = m[idx or 0]
 
-		# Result
-		rv = m[idx or 0]
-		return rv[skey] if skey else rv
+		return node
 
 	def __contains__(self, key):
 		# Key conversion/validation
 		if len(key) != 4:
 			return False
-		key = struct.unpack('>I', bytes(key, 'utf8'))[0]
-
-		# Find all matching children
-		m = [c for c in self.children if c.AID == key]
+		key = Atom.aid_for_tag(key)
 
 		# Any found ?
-		return len(m) > 0
+		return len(self._by_aid.get(key, [])) > 0
 
-	def serialize(self):
-		cb = b''.join([c.serialize() for c in self.children])
-		return struct.pack('>II', 8 + len(cb), self.AID) + cb
+	def remove(self, child):
+		self.children.remove(child)
+		self._by_aid[child.AID].remove(child)
+
+	def _serialized_size(self):
+		return 8 + sum([c._serialized_size() for c in self.children])
+
+	def _serialize_into(self, buf, ofs):
+		# Children first, header once we know the final length
+		end = ofs + 8
+		for c in self.children:
+			end = c._serialize_into(buf, end)
+
+		_S_ATOM_HDR.pack_into(buf, ofs, end - ofs, self.AID)
+		return end
 
 	def print(self, lvl=0):
 		print("%6d %08x %s-%s" % (len(self.data), self.AID, lvl*' |', bytes(self.data[4:8]).decode('utf8')))
@@ -183,34 +227,87 @@ class DecodedLeafAtom(Atom):
 		else:
 			self.hdr = None
 
-		# Decode list
-		if self.L is not None:
-			self.lst = []
-			while ofs < len(data):
-				e = self.lst_tuple()(*self.lst_struct().unpack_from(data, offset=ofs))
-				ofs += self.lst_struct().size
-				self.lst.append(e)
-		else:
-			self.lst = None
+		# List is only decoded on first access (see `lst`)
+		self._lst = None
+		self._lst_raw = data[ofs:] if (self.L is not None) else None
+
+	@property
+	def lst(self):
+		if (self._lst is None) and (self._lst_raw is not None):
+			self._lst = list(map(self.lst_tuple()._make, self.lst_struct().iter_unpack(self._lst_raw)))
+		return self._lst
+
+	@lst.setter
+	def lst(self, lst):
+		self._lst = lst
+
+	def lst_column(self, name):
+		# Get a given field for all list entries as an array. If the list
+		# wasn't decoded yet, this is done in bulk from the raw data.
+		if self._lst is not None:
+			return array.array(self.lst_typecode(), [getattr(e, name) for e in self._lst])
+
+		a = array.array(self.lst_typecode())
+		a.frombytes(self._lst_raw)
+		if sys.byteorder == 'little':
+			a.byteswap()
+
+		n = len(self.L)
+		return a[[x[0] for x in self.L].index(name)::n] if (n > 1) else a
+
+	def set_lst_columns(self, **cols):
+		# Replace the whole list, given as one sequence per field. This
+		# directly builds the raw data without going through the tuples.
+		cols = [cols[x[0]] for x in self.L]
+
+		a = array.array(self.lst_typecode(), cols[0] if (len(cols) == 1) else [v for e in zip(*cols) for v in e])
+		if sys.byteorder == 'little':
+			a.byteswap()
+
+		self._lst = None
+		self._lst_raw = a.tobytes()
 
 	def update(self, **kwargs):
 		self.hdr = self.hdr._replace(**kwargs)
 
-	def serialize(self):
-		# Serialize header
+	def _serialized_size(self):
+		size = 8
+
 		if self.H is not None:
-			hs = self.hdr_struct().pack(*self.hdr)
+			size += self.hdr_struct().size
+
+		if self.L is None:
+			pass
+		elif self._lst is None:
+			size += len(self._lst_raw)
 		else:
-			hs = b''
+			size += len(self._lst) * self.lst_struct().size
+
+		return size
+
+	def _serialize_into(self, buf, ofs):
+		o = ofs + 8
 
-		# Serialize list
-		if self.L is not None:
-			ls = b''.join([self.lst_struct().pack(*e) for e in self.lst])
+		# Serialize header
+		if self.H is not None:
+			self.hdr_struct().pack_into(buf, o, *self.hdr)
+			o += self.hdr_struct().size
+
+		# Serialize list (re-use raw data if it was never decoded)
+		if self.L is None:
+			pass
+		elif self._lst is None:
+			buf[o:o+len(self._lst_raw)] = self._lst_raw
+			o += len(self._lst_raw)
 		else:
-			ls = b''
+			ls = self.lst_struct()
+			for e in self._lst:
+				ls.pack_into(buf, o, *e)
+				o += ls.size
 
 		# Final
-		return struct.pack('>II', 8 + len(hs) + len(ls), self.AID) + hs + ls
+		_S_ATOM_HDR.pack_into(buf, ofs, o - ofs, self.AID)
+		return o
 
 	@classmethod
 	@functools.lru_cache
@@ -240,6 +337,16 @@ class DecodedLeafAtom(Atom):
 			[x[0] for x in cls.L]
 		) if (cls.L is not None) else None
 
+	@classmethod
+	@functools.lru_cache
+	def lst_typecode(cls):
+		# All fields of the list entries must share the same type so the
+		# list can be handled as a flat array
+		tc = set([x[1] for x in cls.L])
+		if len(tc) != 1:
+			raise TypeError('List fields with mixed types can\'t be used as array')
+		return tc.pop()
+
 
 
 class AtomMOOV(ContainerAtom):
@@ -454,10 +561,30 @@ class AtomILST(LeafAtom):
 # BRAW file reader
 # ----------------------------------------------------------------------------
 
-class BrawReader:
+class BrawFrames:
+
+	def __init__(self, mv, offsets, sizes):
+		self.mv = mv
+		self.offsets = offsets
+		self.sizes = sizes
+
+	def __len__(self):
+		return len(self.offsets)
+
+	def __getitem__(self, idx):
+		# Slicing only slices the offset/size arrays
+		if isinstance(idx, slice):
+			return BrawFrames(self.mv, self.offsets[idx], self.sizes[idx])
+
+		fo = self.offsets[idx]
+		return self.mv[fo:fo+self.sizes[idx]]
+
+	def __iter__(self):
+		for fo, fs in zip(self.offsets, self.sizes):
+			yield self.mv[fo:fo+fs]
 
-	K_WIDE = 0x77696465		# 'wide'
-	K_MDAT = 0x6d646174		# 'mdat'
+
+class BrawReader:
 
 	def __init__(self, filename):
 		self.fileno = os.open(filename, os.O_RDONLY)
@@ -470,19 +597,24 @@ class BrawReader:
 
 	def parse(self):
 		# MetaData pointer
-		mp = struct.unpack('>IIII', self.mv[0:16])
+		mp = self.mv[0:16]
 
-		if (mp[0:2] == (8, self.K_WIDE)) and (mp[3] == self.K_MDAT):
+		if (mp[0:8] == b'\x00\x00\x00\x08wide') and (mp[12:16] == b'mdat'):
 			# Format 1 -> be32:8, be32:'wide', be32:(ptr-8), be32:'mdat'
-			self.md_ofs = mp[2] + 8
+			self.md_ofs = int.from_bytes(mp[8:12], 'big') + 8
 
-		elif mp[0:2] == (1, self.K_MDAT):
+		elif mp[0:8] == b'\x00\x00\x00\x01mdat':
 			# Format 2 -> be32:1, be32:'mdat', be64:ptr
-			self.md_ofs = (mp[2] << 32) | mp[3]
+			self.md_ofs = int.from_bytes(mp[8:16], 'big')
 
 		else:
 			raise RuntimeError('Unknown metadata pointer format')
 
+		# Let the kernel know we'll need the whole metadata block
+		if hasattr(mmap, 'MADV_WILLNEED') and (self.md_ofs < self.mm.size()):
+			ofs = self.md_ofs & ~(mmap.PAGESIZE - 1)
+			self.mm.madvise(mmap.MADV_WILLNEED, ofs, self.mm.size() - ofs)
+
 		# MetaData block
 		self.md_blk  = self.mv[self.md_ofs:self.mm.size()]
 		self.md_atom = Atom.for_buf(self.md_blk)
@@ -538,18 +670,31 @@ class BrawReader:
 		if v_stsz.hdr.num_entries != v_co64.hdr.num_entries:
 			raise ValueError('Inconsistent number of entried in STSZ & CO64')
 
-		self.frames = []
+		nf = v_stsz.hdr.num_entries
+		self.frame_sizes   = v_stsz.lst_column('size')[:nf]
+		self.frame_offsets = v_co64.lst_column('offset')[:nf]
 
-		for i in range(v_stsz.hdr.num_entries):
-			fs = v_stsz.lst[i].size
-			fo = v_co64.lst[i].offset
-			self.frames.append( self.mv[fo:fo+fs] )
+		if (len(self.frame_sizes) != nf) or (len(self.frame_offsets) != nf):
+			raise ValueError('Truncated STSZ / CO64 lists')
+
+		self.frames = BrawFrames(self.mv, self.frame_offsets, self.frame_sizes)
 
 
 # ----------------------------------------------------------------------------
 # BRAW Timelapse generator
 # ----------------------------------------------------------------------------
 
+def plan_chunks(sizes, base):
+	# Place chunks of the given sizes back to back, page aligned, starting
+	# at `base`. Returns the array of offsets and the final end offset
+	ofs = array.array('Q', itertools.accumulate(
+		[(s + 4095) & ~4095 for s in sizes],
+		initial = base
+	))
+	end = ofs.pop()
+	return ofs, end
+
+
 class BrawTimelapser:
 
 	def __init__(self, src):
@@ -569,7 +714,7 @@ class BrawTimelapser:
 
 		# Remove audio track
 		if self.src.trk_aud_idx != -1:
-			md_atom.children.remove( md_atom['trak:%d' % self.src.trk_aud_idx] )
+			md_atom.remove( md_atom['trak:%d' % self.src.trk_aud_idx] )
 
 		# 'mvhd' duration
 		md_atom['mvhd'].update(duration=nf_new)
@@ -593,15 +738,11 @@ class BrawTimelapser:
 		# Build new list of frames offset/size
 		v_stsz = v_trak['mdia/minf/stbl/stsz']
 		v_stsz.update(num_entries=nf_new, sample_size=0)
-		v_stsz.lst = []
+		v_stsz.set_lst_columns(size=self.frames_data.sizes)
 
 		v_co64 = v_trak['mdia/minf/stbl/co64']
 		v_co64.update(num_entries=nf_new)
-		v_co64.lst = []
-
-		for fo, fd in zip(self.frames_offset, self.frames_data):
-			v_stsz.lst.append( v_stsz.lst_tuple()(size=len(fd)) )
-			v_co64.lst.append( v_co64.lst_tuple()(offset=fo) )
+		v_co64.set_lst_columns(offset=self.frames_offset)
 
 		# Done
 		return md_atom.serialize()
@@ -618,7 +759,7 @@ class BrawTimelapser:
 		# Clean header
 		self.header = bytearray(16)
 
-	def add_chunk(self, data, offset=None):
+	def add_chunk(self, data, offset=None, src_offset=None):
 		# Handle requested offset
 		if offset is not None:
 			if offset > self.write_offset:
@@ -626,7 +767,7 @@ class BrawTimelapser:
 			self.write_offset = offset
 
 		# Add to the list
-		self.write_list.append( (self.write_offset, data) )
+		self.write_list.append( (self.write_offset, data, src_offset) )
 		rv = self.write_offset
 
 		# Next offset aligned to page
@@ -640,13 +781,67 @@ class BrawTimelapser:
 			raise RuntimeError('Not overwriting destination file')
 
 		fh = open(fn, 'wb')
+		fd = fh.fileno()
+
+		# Allocate the whole file upfront
+		if hasattr(os, 'posix_fallocate'):
+			try:
+				os.posix_fallocate(fd, 0, max([wo + len(wd) for wo, wd, so in self.write_list]))
+			except OSError:
+				pass
+
+		# Frames are read from the source in increasing offset order
+		if hasattr(os, 'posix_fadvise'):
+			os.posix_fadvise(self.src.fileno, 0, 0, os.POSIX_FADV_SEQUENTIAL)
 
-		for wo, wd in self.write_list:
-			fh.seek(wo)
-			fh.write(wd)
+		# Chunks coming straight from the source file are copied in-kernel
+		# when supported
+		self.use_cfr = hasattr(os, 'copy_file_range')
+
+		for wo, wd, so in self.write_list:
+			if so is not None:
+				self._copy_chunk(fh, wo, so, len(wd))
+			else:
+				self._write_at(fh, wo, wd)
+
+		# Video frames
+		for wo, so, sz in zip(self.frames_offset, self.frames_data.offsets, self.frames_data.sizes):
+			self._copy_chunk(fh, wo, so, sz)
 
 		fh.close()
 
+	def _copy_chunk(self, fh, dst_ofs, src_ofs, length):
+		if self.use_cfr:
+			try:
+				self._copy_range(fh.fileno(), dst_ofs, src_ofs, length)
+				return
+			except OSError:
+				self.use_cfr = False
+
+		self._write_at(fh, dst_ofs, self.src.mv[src_ofs:src_ofs+length])
+
+	def _write_at(self, fh, ofs, data):
+		# Single pwrite() syscall instead of seek + write when available
+		if not hasattr(os, 'pwrite'):
+			fh.seek(ofs)
+			fh.write(data)
+			return
+
+		mv = memoryview(data)
+		while len(mv):
+			n = os.pwrite(fh.fileno(), mv, ofs)
+			mv = mv[n:]
+			ofs += n
+
+	def _copy_range(self, fd, dst_ofs, src_ofs, length):
+		while length:
+			n = os.copy_file_range(self.src.fileno, fd, length, src_ofs, dst_ofs)
+			if n == 0:
+				raise OSError('Short copy from source file')
+			src_ofs += n
+			dst_ofs += n
+			length -= n
+
 	def handle_header(self):
 		K_WIDE = 0x77696465		# 'wide'
 		K_MDAT = 0x6d646174		# 'mdat'
@@ -664,11 +859,13 @@ class BrawTimelapser:
 			raise RuntimeError('Unexpected timecode track format')
 
 		# Add it
-		self.add_chunk(self.src.mv[0x1000:0x1004], 0x1000)
+		self.add_chunk(self.src.mv[0x1000:0x1004], 0x1000, 0x1000)
 
 	def handle_frames(self):
-		for f in self.frames_data:
-			self.frames_offset.append( self.add_chunk(f) )
+		# Frames are placed back to back (page aligned) from the current
+		# offset. They're not put in the write list but written directly
+		# from the source by `write_chunks`
+		self.frames_offset, self.write_offset = plan_chunks(self.frames_data.sizes, self.write_offset)
 
 	def generate(self, dst_filename, n, start=0):
 		# Reset
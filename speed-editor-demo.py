@@ -17,7 +17,7 @@ class DemoHandler(SpeedEditorHandler):
 
 	def __init__(self, se):
 		self.se   = se
-		self.keys = []
+		self.keys = frozenset()
 		self.leds = 0
 		self.se.set_leds(self.leds)
 		self._set_jog_mode_for_key(SpeedEditorKey.SHTL)
@@ -39,14 +39,16 @@ class DemoHandler(SpeedEditorHandler):
 		print(f"Keys held: {kl:s}")
 
 		# Find keys being released and toggle led if there is one
-		for k in self.keys:
-			if k not in keys:
-				# Select jog mode
-				self._set_jog_mode_for_key(k)
-
-				# Toggle leds
-				self.leds ^= getattr(SpeedEditorLed, k.name, 0)
-				self.se.set_leds(self.leds)
+		keys = frozenset(keys)
+
+		for k in (self.keys - keys):
+			# Select jog mode
+			self._set_jog_mode_for_key(k)
+
+			# Toggle leds
+			self.leds ^= getattr(SpeedEditorLed, k.name, 0)
+
+		self.se.set_leds(self.leds)
 
 		self.keys = keys
 